@@ -37,6 +37,114 @@ class Command(CommandDispatcher):
             make_option("-n", "--baz-name",
                 action="store", type="string", dest="baz_name"),
         },
+        'loadtest': [
+            make_option("-u", "--url",
+                action="store", type="string", dest="url", default=None,
+                help="The site to load (default: ckan.site_url)"),
+            make_option("-d", "--datasets",
+                action="store", type="int", dest="num_datasets", default=100),
+            make_option("-o", "--organizations",
+                action="store", type="int", dest="num_organizations", default=5),
+            make_option("-e", "--extras",
+                action="store", type="int", dest="num_extras", default=5),
+            make_option("-g", "--genres",
+                action="store", type="int", dest="num_genres", default=6),
+            make_option("-c", "--concurrency",
+                action="store", type="int", dest="concurrency", default=8),
+            make_option("-r", "--requests",
+                action="store", type="int", dest="num_requests", default=900),
+            make_option("-p", "--prefix",
+                action="store", type="string", dest="prefix", default="loadtest"),
+            make_option("--no-generate",
+                action="store_false", dest="generate", default=True,
+                help="Assume the synthetic catalogue is already there (required if --url is not ckan.site_url)"),
+            make_option("--cleanup",
+                action="store_true", dest="cleanup", default=False,
+                help="Only delete the synthetic catalogue (datasets, organizations and genres)"),
+            make_option("--api-key",
+                action="store", type="string", dest="api_key", default=None,
+                help="The api key to act as (required if --url is not ckan.site_url)"),
+        ],
+        'replay': [
+            make_option("-u", "--url",
+                action="store", type="string", dest="url", default=None,
+                help="The (test) site to replay against (default: ckan.site_url)"),
+            make_option("-s", "--speed",
+                action="store", type="float", dest="speed", default=1.0,
+                help="Speed-up factor for recorded timings (0 for as fast as possible)"),
+            make_option("-c", "--concurrency",
+                action="store", type="int", dest="concurrency", default=4),
+            make_option("-k", "--kinds",
+                action="store", type="string", dest="kinds", default="create,update,search,show",
+                help="Comma-separated kinds of records to replay"),
+            make_option("--api-key",
+                action="store", type="string", dest="api_key", default=None,
+                help="The api key to act as (required if --url is not ckan.site_url)"),
+        ],
+        'retag': [
+            make_option("-q", "--query",
+                action="store", type="string", dest="query", default="*:*",
+                help="Select datasets by a search query"),
+            make_option("-o", "--organization",
+                action="store", type="string", dest="organization", default=None,
+                help="Select datasets by organization (name or id)"),
+            make_option("--set",
+                action="store", type="string", dest="set_genre", default=None,
+                help="Set the music genre to GENRE", metavar="GENRE"),
+            make_option("--rename",
+                action="store", type="string", dest="rename_genre", default=None,
+                help="Rename a music genre", metavar="OLD:NEW"),
+            make_option("--remove",
+                action="store", type="string", dest="remove_genre", default=None,
+                help="Remove a music genre", metavar="GENRE"),
+            make_option("-w", "--workers",
+                action="store", type="int", dest="workers", default=4),
+            make_option("-b", "--batch-size",
+                action="store", type="int", dest="batch_size", default=200),
+            make_option("-l", "--rate-limit",
+                action="store", type="float", dest="rate_limit", default=0,
+                help="Max datasets processed per second (0 for no limit)"),
+            make_option("-n", "--dry-run",
+                action="store_true", dest="dry_run", default=False,
+                help="Only print the changes that would be made"),
+        ],
+        'stats': [
+            make_option("-f", "--format",
+                action="store", type="choice", choices=["csv", "json"], dest="format", default="csv"),
+            make_option("-o", "--output",
+                action="store", type="string", dest="output", default=None,
+                help="Write to a file (default: stdout)"),
+            make_option("-k", "--capacity",
+                action="store", type="int", dest="capacity", default=1000,
+                help="Max distinct values tracked per dimension"),
+        ],
+        'memprofile': [
+            make_option("-d", "--datasets",
+                action="store", type="int", dest="num_datasets", default=500,
+                help="Number of datasets per workload"),
+            make_option("-s", "--stages",
+                action="store", type="string", dest="stages", default=None,
+                help="Comma-separated stages to profile (default: all)"),
+            make_option("-t", "--top",
+                action="store", type="int", dest="top", default=10,
+                help="Number of allocation sites reported per stage"),
+            make_option("-b", "--baseline",
+                action="store", type="string", dest="baseline", default=None,
+                help="Compare against a stored baseline"),
+            make_option("--save-baseline",
+                action="store", type="string", dest="save_baseline", default=None,
+                help="Store results as a baseline"),
+            make_option("--tolerance",
+                action="store", type="float", dest="tolerance", default=0.1,
+                help="Relative peak increase reported as a regression"),
+        ],
+        'validate': [
+            make_option("-u", "--update",
+                action="store_const", const="update", dest="schema", default="create",
+                help="Validate against the update schema (default: create)"),
+            make_option("-b", "--batch-size",
+                action="store", type="int", dest="batch_size", default=500),
+        ],
     }
 
     @CommandDispatcher.subcommand(name='foo', options=options_spec['foo'])
@@ -49,6 +157,232 @@ class Command(CommandDispatcher):
         '''Run baz command'''
         self.logger.info('Running "baz" with args: %r %r', opts, args)
 
+    @CommandDispatcher.subcommand(name='loadtest', options=options_spec['loadtest'])
+    def invoke_loadtest(self, opts, *args):
+        '''Generate a synthetic catalogue and load-test dataset read, edit and search pages'''
+        from pylons import config
+        from ckanext.helloworld.lib import loadtest
+        from ckanext.helloworld.plugins import DatasetForm
+
+        context = {'model':model,'session':model.Session,'ignore_auth':True}
+        site_user = get_action('get_site_user')(context,{})
+        context.update({'user': site_user.get('name')})
+
+        if opts.cleanup:
+            loadtest.cleanup_catalogue(context, opts.prefix)
+            if DatasetForm.shared_cache:
+                DatasetForm.shared_cache.invalidate('music_genres')
+            return
+
+        site_url = config.get('ckan.site_url')
+        url = opts.url or site_url
+        if not url:
+            self.logger.error('No site url: use --url or set ckan.site_url')
+            return
+        if not loadtest.is_site_url(url, site_url):
+            # The catalogue is generated in the local database, which another site doesn't see
+            if opts.generate:
+                self.logger.error('A --url other than ckan.site_url requires --no-generate')
+                return
+            # Never send the site user's (sysadmin) key to some other site
+            if not opts.api_key:
+                self.logger.error('An explicit --api-key is required for a --url other than ckan.site_url')
+                return
+
+        genres = loadtest.genre_names(opts.num_genres, DatasetForm.MUSIC_GENRES, opts.prefix)
+        if opts.generate:
+            DatasetForm.create_music_genres()
+            names = loadtest.generate_catalogue(context, opts.prefix,
+                opts.num_datasets, opts.num_organizations, opts.num_extras, genres)
+        else:
+            names = [loadtest.make_dataset_dict(opts.prefix, i, [], genres, 0)['name']
+                for i in range(opts.num_datasets)]
+
+        client = loadtest.SiteClient(url, api_key=opts.api_key or site_user.get('apikey'))
+
+        self.logger.info('Running %d requests against %s (concurrency=%d)',
+            opts.num_requests, url, opts.concurrency)
+        stats = loadtest.run_concurrently(
+            loadtest.page_jobs(names, genres, opts.num_requests),
+            lambda path: client.get(path) == 200,
+            opts.concurrency, loadtest.LatencyStats())
+        print stats.format_summary()
+
+    @CommandDispatcher.subcommand(name='replay', options=options_spec['replay'])
+    def invoke_replay(self, opts, *args):
+        '''Replay a log of recorded dataset traffic against a (test) site'''
+        from pylons import config
+        from ckanext.helloworld.lib import loadtest, recorder
+
+        if len(args) != 1:
+            self.logger.error('Expected exactly 1 argument: the recorded log file')
+            return
+
+        site_url = config.get('ckan.site_url')
+        url = opts.url or site_url
+        if not url:
+            self.logger.error('No site url: use --url or set ckan.site_url')
+            return
+
+        api_key = opts.api_key
+        if not api_key:
+            if not loadtest.is_site_url(url, site_url):
+                # Never send the site user's (sysadmin) key to some other site
+                self.logger.error('An explicit --api-key is required for a --url other than ckan.site_url')
+                return
+            context = {'model':model,'session':model.Session,'ignore_auth':True}
+            api_key = get_action('get_site_user')(context,{}).get('apikey')
+
+        client = loadtest.SiteClient(url, api_key=api_key)
+
+        kinds = tuple(k.strip() for k in opts.kinds.split(','))
+        jobs = ((kind, (kind, data))
+            for kind, data in recorder.replay_jobs(recorder.read_log(args[0], kinds), opts.speed))
+
+        self.logger.info('Replaying %s against %s (speed=%s, concurrency=%d)',
+            args[0], url, opts.speed, opts.concurrency)
+        stats = loadtest.run_concurrently(jobs,
+            lambda job: recorder.replay_record(client, *job) == 200,
+            opts.concurrency, loadtest.LatencyStats())
+        print stats.format_summary()
+
+    @CommandDispatcher.subcommand(name='retag', options=options_spec['retag'])
+    def invoke_retag(self, opts, *args):
+        '''Set, rename or remove the music genre of the selected datasets (in parallel batches)'''
+        from ckanext.helloworld.lib import loadtest, retag
+        from ckanext.helloworld.plugins import DatasetForm
+
+        if opts.set_genre:
+            operation, genres = retag.set_genre(opts.set_genre), [opts.set_genre]
+        elif opts.rename_genre and ':' in opts.rename_genre:
+            old, new = opts.rename_genre.split(':', 1)
+            operation, genres = retag.rename_genre(old, new), [new]
+        elif opts.remove_genre:
+            operation, genres = retag.remove_genre(opts.remove_genre), []
+        else:
+            self.logger.error('Expected one of --set GENRE, --rename OLD:NEW or --remove GENRE')
+            return
+
+        context = {'model':model,'session':model.Session,'ignore_auth':True}
+        site_user = get_action('get_site_user')(context,{})
+
+        rate_limiter = retag.RateLimiter(opts.rate_limit) if opts.rate_limit else None
+        retagger = retag.Retagger(operation, site_user.get('name'), opts.dry_run, rate_limiter)
+        if not opts.dry_run and retagger.ensure_tags(genres) and DatasetForm.shared_cache:
+            DatasetForm.shared_cache.invalidate('music_genres')
+
+        package_ids = retag.search_package_ids(opts.query, opts.organization)
+        stats = loadtest.run_concurrently(
+            (('batch', ids) for ids in retag.batches(package_ids, opts.batch_size)),
+            retagger, opts.workers, loadtest.LatencyStats())
+
+        for name, current, genres in retagger.diffs:
+            print '%s: %s -> %s' %(name, ', '.join(current) or '-', ', '.join(genres) or '-')
+        self.logger.info('%s %d of %d datasets', 'Would re-tag' if opts.dry_run else 'Re-tagged',
+            retagger.changed, retagger.processed)
+        print stats.format_summary()
+
+    @CommandDispatcher.subcommand(name='stats', options=options_spec['stats'])
+    def invoke_stats(self, opts, *args):
+        '''Report genre, organization and field statistics (streaming over all datasets)'''
+        from ckanext.helloworld.lib.stats import CatalogueStats
+
+        stats = CatalogueStats(capacity=opts.capacity).compute()
+        fp = open(opts.output, 'w') if opts.output else sys.stdout
+        try:
+            if opts.format == 'json':
+                stats.write_json(fp)
+            else:
+                stats.write_csv(fp)
+        finally:
+            if opts.output:
+                fp.close()
+        self.logger.info('Computed statistics for %d datasets', stats.num_datasets)
+
+    @CommandDispatcher.subcommand(name='memprofile', options=options_spec['memprofile'])
+    def invoke_memprofile(self, opts, *args):
+        '''Profile peak memory and allocation sites of the plugin's schemas, hooks and helpers'''
+        import pylons
+        from pylons.util import AttribSafeContextObj
+        from paste.registry import Registry
+        from ckanext.helloworld.lib import memprofile
+        from ckanext.helloworld.plugins import DatasetForm
+
+        stages = opts.stages.split(',') if opts.stages else memprofile.Workloads.STAGES
+        unknown = set(stages) - set(memprofile.Workloads.STAGES)
+        if unknown:
+            self.logger.error('Unknown stages: %s', ', '.join(unknown))
+            return
+
+        if not memprofile.tracemalloc:
+            self.logger.warn('tracemalloc is not available: reporting RSS growth and object types instead')
+        method = 'tracemalloc' if memprofile.tracemalloc else 'rss'
+
+        # Only compare with a baseline measured the same way
+        baseline = None
+        if opts.baseline:
+            try:
+                baseline = memprofile.load_baseline(opts.baseline, method, opts.num_datasets)
+            except ValueError as ex:
+                self.logger.error('Cannot compare against the baseline: %s', ex)
+                return
+
+        context = {'model':model,'session':model.Session,'ignore_auth':True}
+        site_user = get_action('get_site_user')(context,{})
+        context.update({'user': site_user.get('name')})
+
+        # The helpers expect a template context (i.e. c.user), as inside a request
+        registry = Registry()
+        registry.prepare()
+        registry.register(pylons.c, AttribSafeContextObj())
+        pylons.c.user = site_user.get('name')
+
+        # Measure the real lookups, not the shared cache
+        shared_cache, DatasetForm.shared_cache = DatasetForm.shared_cache, None
+
+        # Note Restore both, as the dispatcher (and the process) may go on with other commands
+        try:
+            plugin = DatasetForm()
+            results = memprofile.Workloads(plugin, context, opts.num_datasets).run(stages, opts.top)
+        finally:
+            DatasetForm.shared_cache = shared_cache
+            registry.cleanup()
+
+        print memprofile.format_report(results, baseline, opts.tolerance)
+        if opts.save_baseline:
+            memprofile.save_baseline(opts.save_baseline, results, method, opts.num_datasets)
+            self.logger.info('Saved baseline to %s', opts.save_baseline)
+
+    @CommandDispatcher.subcommand(name='validate', options=options_spec['validate'])
+    def invoke_validate(self, opts, *args):
+        '''Validate datasets (a JSON list, or JSON lines) from a file without writing anything'''
+        if len(args) != 1:
+            self.logger.error('Expected exactly 1 argument: the file of datasets')
+            return
+
+        with open(args[0]) as fp:
+            text = fp.read().strip()
+        if text.startswith('['):
+            datasets = json.loads(text)
+        else:
+            datasets = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+        context = {'model':model,'session':model.Session,'ignore_auth':True}
+        site_user = get_action('get_site_user')(context,{})
+        context.update({'user': site_user.get('name')})
+
+        num_invalid = 0
+        for start in range(0, len(datasets), opts.batch_size):
+            batch = datasets[start:start + opts.batch_size]
+            results = get_action('package_validate_many')(dict(context),
+                { 'datasets': batch, 'schema': opts.schema })
+            for i, (dataset, result) in enumerate(zip(batch, results)):
+                if not result['valid']:
+                    num_invalid += 1
+                    print '#%d (%s): %s' %(start + i, dataset.get('name') or dataset.get('id'),
+                        json.dumps(result['errors']))
+        self.logger.info('%d of %d datasets are invalid', num_invalid, len(datasets))
+
 class Greet(CkanCommand):
     '''
     This is an example of a helloworld-specific paster command:
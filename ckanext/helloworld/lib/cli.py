@@ -1,6 +1,7 @@
 import sys
 import os.path
 import logging
+import threading
 import optparse
 from optparse import make_option 
 import paste.script.command
@@ -15,20 +16,63 @@ def parser_error(msg):
     raise ValueError(msg)
 
 class CommandDispatcher(ckan.lib.cli.CkanCommand):
-    '''A command dispatcher for various helloworld-related subcommands'''
+    '''A command dispatcher for various helloworld-related subcommands.
+
+    Every derived class gets its own registry of subcommands (i.e. of its methods
+    marked by the subcommand decorator), built once on first use along with the
+    option parser of each subcommand and the help listing. So, a dispatcher can
+    be reused for many dispatches (see dispatch) without rebuilding anything.
+    '''
 
     __usage = '''paster [PASTER-OPTIONS] helloworld [--config INI_FILE] [--setup-app] %(name)s [%(name)s-OPTIONS]'''
 
-    __specs = {}
+    __registry_lock = threading.Lock()
+
+    @classmethod
+    def _registry(cls):
+        '''Return the registry of subcommands for this class (built once per class)'''
+        registry = cls.__dict__.get('_subcommand_registry')
+        if registry is None:
+            with CommandDispatcher.__registry_lock:
+                registry = cls.__dict__.get('_subcommand_registry')
+                if registry is None:
+                    registry = cls._build_registry()
+                    cls._subcommand_registry = registry
+        return registry
+
+    @classmethod
+    def _build_registry(cls):
+        specs = {}
+        # Walk the hierarchy from the base, so that derived classes may override subcommands
+        for klass in reversed(cls.__mro__):
+            for attr in vars(klass).values():
+                spec = getattr(attr, '_subcommand_spec', None)
+                if spec:
+                    specs[spec['name']] = { 'method': attr, 'options': spec['options'] }
+        for name, spec in specs.items():
+            parser = cls.standard_parser()
+            parser.set_usage(cls.get_subcommand_usage(name))
+            parser.error = parser_error
+            parser.add_options(option_list=spec['options'])
+            spec['parser'] = parser
+            # A parser keeps state while parsing, so serialize its use
+            spec['lock'] = threading.Lock()
+        help_lines = ['  %s: %s' %(name, (specs[name]['method'].__doc__ or '').strip().split("\n")[0])
+            for name in sorted(specs)]
+        return { 'specs': specs, 'help': '\n'.join(help_lines) }
+
+    @classmethod
+    def get_subcommand_spec(cls, name):
+        return cls._registry()['specs'].get(name)
+
+    @classmethod
+    def get_subcommand_specs(cls):
+        return sorted(cls._registry()['specs'].items())
+
+    @classmethod
+    def get_subcommand_help(cls):
+        return cls._registry()['help']
 
-    @staticmethod
-    def get_subcommand_spec(name):
-        return CommandDispatcher.__specs.get(name)   
-    
-    @staticmethod
-    def get_subcommand_specs():
-        return CommandDispatcher.__specs.items()   
-    
     @staticmethod
     def get_subcommand_usage(name):
         return CommandDispatcher.__usage %(dict(name=name))
@@ -37,12 +81,10 @@ class CommandDispatcher(ckan.lib.cli.CkanCommand):
     def subcommand(name, options=[]):
         '''A parameterized decorator to mark methods of derived classes as subcommands'''
         def decorate(method):
-            CommandDispatcher.__specs.update({
-                name: {
-                    'method': method,
-                    'options': options,
-                },
-            })
+            method._subcommand_spec = {
+                'name': name,
+                'options': list(options),
+            }
             return method
         return decorate
     
@@ -51,6 +93,8 @@ class CommandDispatcher(ckan.lib.cli.CkanCommand):
         self.parser.add_option('--setup-app', 
             action='store_true', dest='setup_app', default=False)
         self.parser.disable_interspersed_args()        
+        self.logger = logging.getLogger('ckanext.helloworld')
+        self.logger.setLevel(logging.INFO)
         
     def command(self):        
         '''Load environment, parse args and dispatch to the proper subcommand
@@ -62,14 +106,17 @@ class CommandDispatcher(ckan.lib.cli.CkanCommand):
         if self.options.setup_app:
             self._setup_app()
 
-        self.logger = logging.getLogger('ckanext.helloworld')
-        self.logger.setLevel(logging.INFO)
-        
         self.logger.debug('Remaining args are ' + repr(self.args))
         self.logger.debug('Options are ' + repr(self.options))
 
         subcommand = self.args.pop(0) if self.args else 'help'
 
+        return self.dispatch(subcommand, self.args)
+
+    def dispatch(self, subcommand, args=[]):
+        '''Parse args for a subcommand and invoke it (assuming the environment is loaded)
+        '''
+
         if subcommand == 'help':
             print self.__doc__
             return
@@ -77,12 +124,10 @@ class CommandDispatcher(ckan.lib.cli.CkanCommand):
         spec = self.get_subcommand_spec(subcommand)
         if spec:
             method = spec['method']
-            parser = self.standard_parser()
-            parser.set_usage(self.get_subcommand_usage(subcommand))
-            parser.error = parser_error
-            parser.add_options(option_list=spec.get('options'))
+            parser = spec['parser']
             try:
-                opts, args = parser.parse_args(args=self.args)
+                with spec['lock']:
+                    opts, args = parser.parse_args(args=list(args))
             except Exception as ex:
                 self.logger.error('Bad options for subcommand %s: %s', subcommand, str(ex))
                 print 
@@ -97,8 +142,6 @@ class CommandDispatcher(ckan.lib.cli.CkanCommand):
         else:
             self.logger.error('Got an unknown subcommand: %s' %(subcommand))
             print 'The available helloworld commands are:'
-            for k, spec in self.get_subcommand_specs():
-                method = spec['method']    
-                print '  %s: %s' %(k, method.__doc__.split("\n")[0])
+            print self.get_subcommand_help()
             return
     
@@ -0,0 +1,147 @@
+import re
+import calendar
+import hashlib
+import logging
+import urlparse
+from email.utils import formatdate
+
+from sqlalchemy import or_, and_, func
+
+import ckan.model as model
+
+log1 = logging.getLogger(__name__)
+
+def _stamp(t):
+    '''Return a (naive, UTC) datetime as microseconds since the epoch'''
+    return calendar.timegm(t.timetuple()) * 1000000 + t.microsecond if t else 0
+
+def lookup_revision(name_or_id):
+    '''Return the validators of a public active dataset as (stamp, token), or None.
+
+    The dataset itself is identified by its revision stamp (bumped on every update). A
+    dataset not updated since the stamp was introduced has none, and falls back to its
+    (core) revision and metadata_modified. Besides the dataset, its page (and package_show)
+    depends on its organization, its groups and its followers: the token identifies the
+    state of all of them, and the stamp (in microseconds) is the latest of their known
+    modification times.
+    '''
+    Package, PackageExtra = model.Package, model.PackageExtra
+    Group, Member, Revision = model.Group, model.Member, model.Revision
+    session = model.Session
+    q = session.query(Package.id, Package.revision_id, Package.metadata_modified, Package.owner_org,
+        PackageExtra.value).outerjoin(PackageExtra, and_(Package.id == PackageExtra.package_id,
+            PackageExtra.key == 'record_revision', PackageExtra.state == 'active'))
+    q = q.filter(or_(Package.id == name_or_id, Package.name == name_or_id))
+    q = q.filter(Package.state == 'active').filter(Package.private == False)
+    try:
+        row = q.first()
+        if not row:
+            return None
+        package_id, revision_id, metadata_modified, owner_org, revision = row
+        if revision:
+            parts, stamps = ['r' + revision], [int(revision)]
+        else:
+            parts, stamps = ['m' + unicode(revision_id)], [_stamp(metadata_modified)]
+        revision_ids = set()
+        if owner_org:
+            for group_id, group_revision_id in session.query(Group.id, Group.revision_id).filter(
+                    Group.id == owner_org):
+                parts.extend((group_id, group_revision_id))
+                revision_ids.add(group_revision_id)
+        q = session.query(Member.id, Member.revision_id, Group.id, Group.revision_id).join(
+            Group, Group.id == Member.group_id)
+        q = q.filter(Member.table_name == 'package').filter(Member.table_id == package_id)
+        q = q.filter(Member.state == 'active')
+        for member in sorted(q):
+            parts.extend(member)
+            revision_ids.update((member[1], member[3]))
+        num_followers = session.query(func.count(model.UserFollowingDataset.follower_id)).filter(
+            model.UserFollowingDataset.object_id == package_id).scalar()
+        parts.append(num_followers)
+        revision_ids.discard(None)
+        if revision_ids:
+            t = session.query(func.max(Revision.timestamp)).filter(Revision.id.in_(revision_ids)).scalar()
+            stamps.append(_stamp(t))
+    finally:
+        session.remove()
+    return max(stamps), '|'.join(unicode(part) for part in parts).encode('utf-8')
+
+class ConditionalGetMiddleware(object):
+    '''Answer GET/HEAD requests for dataset pages and package_show with ETag and
+    Last-Modified headers derived from the dataset's validators (see lookup_revision),
+    and short-circuit them with a "304 Not Modified" when the client's copy is still current.
+
+    The ETag also depends on the request's path, query, cookies, credentials and
+    language (as the rendered output does), so a client only gets a 304 for a
+    response it was actually served.
+
+    Only the ETag is compared: If-Modified-Since is ignored, since not every change
+    (e.g. a follower leaving) leaves a modification time behind.
+    '''
+
+    DATASET_PATH = re.compile(r'^(?:/[a-z]{2}(?:_[A-Za-z]{2})?)?/dataset/([^/]+)/?$')
+
+    API_PATH = re.compile(r'^/api(?:/\d+)?/action/package_show/?$')
+
+    VARY = ('PATH_INFO', 'QUERY_STRING', 'HTTP_COOKIE', 'HTTP_AUTHORIZATION',
+        'HTTP_X_CKAN_API_KEY', 'HTTP_ACCEPT_LANGUAGE')
+
+    def __init__(self, app, lookup=lookup_revision, salt=''):
+        self.app = app
+        self.lookup = lookup
+        self.salt = salt
+
+    def dataset_of(self, environ):
+        '''Return the name (or id) of the dataset requested, if this is a request we handle'''
+        if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return None
+        path = environ.get('PATH_INFO', '')
+        m = self.DATASET_PATH.match(path)
+        if m:
+            return m.group(1)
+        if self.API_PATH.match(path):
+            return urlparse.parse_qs(environ.get('QUERY_STRING', '')).get('id', [None])[0]
+        return None
+
+    def etag(self, revision, environ, token=''):
+        h = hashlib.sha1(self.salt)
+        h.update('\0' + token)
+        for k in self.VARY:
+            h.update('\0' + environ.get(k, ''))
+        return 'W/"%x-%s"' % (revision, h.hexdigest()[:16])
+
+    @staticmethod
+    def is_not_modified(environ, etag):
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            return etag in [t.strip() for t in if_none_match.split(',')] or if_none_match.strip() == '*'
+        return False
+
+    def __call__(self, environ, start_response):
+        name = self.dataset_of(environ)
+        found = None
+        if name:
+            try:
+                found = self.lookup(name)
+            except Exception as ex:
+                log1.warn('Failed to lookup the revision of dataset %s: %s', name, ex)
+        if found is None:
+            return self.app(environ, start_response)
+
+        revision, token = found
+        validators = [
+            ('ETag', self.etag(revision, environ, token)),
+            ('Last-Modified', formatdate(revision / 1e6, usegmt=True)),
+        ]
+
+        if self.is_not_modified(environ, validators[0][1]):
+            start_response('304 Not Modified', validators)
+            return []
+
+        def _start_response(status, headers, exc_info=None):
+            if status.startswith('200'):
+                headers = [(k, v) for k, v in headers
+                    if k.lower() not in ('etag', 'last-modified')] + validators
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, _start_response)
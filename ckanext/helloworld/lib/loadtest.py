@@ -0,0 +1,248 @@
+import time
+import math
+import json
+import random
+import urllib
+import urllib2
+import urlparse
+import logging
+import threading
+import Queue
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+log1 = logging.getLogger(__name__)
+
+def is_site_url(url, site_url):
+    '''Check if url points to this site (i.e. to ckan.site_url), so that the
+    site user's api key may be sent to it'''
+    if not url or not site_url:
+        return False
+    a, b = urlparse.urlsplit(url), urlparse.urlsplit(site_url)
+    return (a.scheme.lower(), a.netloc.lower(), a.path.rstrip('/')) == \
+        (b.scheme.lower(), b.netloc.lower(), b.path.rstrip('/'))
+
+class SiteClient(object):
+    '''A minimal HTTP client for a running CKAN site (web pages and action api)'''
+
+    def __init__(self, url, api_key=None, timeout=60):
+        self.url = url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def _request(self, path, data=None):
+        headers = {}
+        if self.api_key:
+            headers['Authorization'] = self.api_key
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+            data = json.dumps(data)
+        return urllib2.Request(urlparse.urljoin(self.url + '/', path.lstrip('/')), data, headers)
+
+    def get(self, path):
+        '''Fetch a page, return its HTTP status (the body is read and discarded)'''
+        try:
+            resp = urllib2.urlopen(self._request(path), timeout=self.timeout)
+        except urllib2.HTTPError as ex:
+            return ex.code
+        resp.read()
+        return resp.getcode()
+
+    def action(self, name, data_dict):
+        '''Invoke an action api call, return its HTTP status and the parsed response'''
+        try:
+            resp = urllib2.urlopen(self._request('api/3/action/%s' % (name), data_dict), timeout=self.timeout)
+        except urllib2.HTTPError as ex:
+            return ex.code, None
+        return resp.getcode(), json.loads(resp.read())
+
+class LatencyStats(object):
+    '''Collect (thread-safe) latency samples per label and summarize them'''
+
+    PERCENTILES = (50, 90, 95, 99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._errors = {}
+        self.started_at = None
+        self.finished_at = None
+
+    def add(self, label, elapsed, ok=True):
+        with self._lock:
+            self._samples.setdefault(label, []).append(elapsed)
+            if not ok:
+                self._errors[label] = self._errors.get(label, 0) + 1
+
+    @staticmethod
+    def percentile(sorted_samples, p):
+        '''Nearest-rank percentile of an already sorted list'''
+        if not sorted_samples:
+            return None
+        i = int(math.ceil(p / 100.0 * len(sorted_samples))) - 1
+        return sorted_samples[max(0, min(i, len(sorted_samples) - 1))]
+
+    def summary(self):
+        '''Return a list of dicts (one per label) with count, errors, throughput and percentiles'''
+        duration = (self.finished_at or time.time()) - (self.started_at or time.time())
+        results = []
+        for label in sorted(self._samples):
+            samples = sorted(self._samples[label])
+            r = {
+                'label': label,
+                'count': len(samples),
+                'errors': self._errors.get(label, 0),
+                'throughput': len(samples) / duration if duration > 0 else None,
+                'mean': sum(samples) / len(samples),
+                'max': samples[-1],
+            }
+            for p in self.PERCENTILES:
+                r['p%d' % (p)] = self.percentile(samples, p)
+            results.append(r)
+        return results
+
+    def format_summary(self):
+        lines = ['%-10s %8s %7s %10s %9s %9s %9s %9s %9s' % (
+            'label', 'count', 'errors', 'req/s', 'p50(ms)', 'p90(ms)', 'p95(ms)', 'p99(ms)', 'max(ms)')]
+        for r in self.summary():
+            lines.append('%-10s %8d %7d %10.2f %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+                r['label'], r['count'], r['errors'], r['throughput'] or 0.0,
+                r['p50'] * 1e3, r['p90'] * 1e3, r['p95'] * 1e3, r['p99'] * 1e3, r['max'] * 1e3))
+        return '\n'.join(lines)
+
+def run_concurrently(jobs, fn, concurrency, stats):
+    '''Feed an iterable of (label, arg) jobs to `concurrency` worker threads, each invoking
+    fn(arg) and recording its latency under label. A job is counted as failed when fn
+    raises or returns a false value.
+    '''
+    q = Queue.Queue(maxsize=concurrency * 4)
+
+    def worker():
+        while True:
+            job = q.get()
+            if job is None:
+                break
+            label, arg = job
+            t0 = time.time()
+            try:
+                ok = fn(arg)
+            except Exception as ex:
+                log1.warn('Job %s(%r) failed: %s', label, arg, ex)
+                ok = False
+            stats.add(label, time.time() - t0, bool(ok))
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    stats.started_at = time.time()
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for job in jobs:
+        q.put(job)
+    for t in threads:
+        q.put(None)
+    for t in threads:
+        t.join()
+    stats.finished_at = time.time()
+    return stats
+
+## Synthetic catalogue ##
+
+def genre_names(num_genres, base_genres, prefix):
+    '''Return num_genres genre names, starting from the plugin's predefined ones.
+    Any further (synthetic) genres are named after the prefix, so that cleanup_catalogue
+    can tell them apart.
+    '''
+    names = list(base_genres[:num_genres])
+    names.extend('%s-genre-%d' % (prefix, i) for i in range(len(names), num_genres))
+    return names
+
+def make_organization_dict(prefix, i):
+    return {
+        'name': '%s-org-%d' % (prefix, i),
+        'title': '%s organization #%d' % (prefix.capitalize(), i),
+        'description': 'A synthetic organization',
+    }
+
+def make_dataset_dict(prefix, i, org_names, genres, num_extras, rnd=random):
+    '''Build a package_create payload exercising all of the plugin's fields'''
+    return {
+        'name': '%s-dataset-%d' % (prefix, i),
+        'title': '%s dataset #%d' % (prefix.capitalize(), i),
+        'notes': 'A synthetic dataset (%d)' % (i),
+        'owner_org': org_names[i % len(org_names)] if org_names else None,
+        'music_title': 'synthetic piece no. %d' % (i),
+        'music_genre': rnd.choice(genres),
+        'foo.x1': 'x1-%d' % (rnd.randint(0, 99)),
+        'tags': [{ 'name': 'loadtest' }],
+        'extras': [{ 'key': 'extra_%d' % (k), 'value': 'value %d/%d' % (i, k) } for k in range(num_extras)],
+    }
+
+def generate_catalogue(context, prefix, num_datasets, num_organizations, num_extras, genres):
+    '''Create (if missing) the organizations, genres and datasets of a synthetic catalogue,
+    through the action api (hence through the plugin's create schema). Return the dataset names.
+    '''
+    get_action = toolkit.get_action
+
+    vocab = get_action('vocabulary_show')(dict(context), { 'id': 'music_genres' })
+    existing_genres = set(t['name'] for t in vocab.get('tags', []))
+    for name in genres:
+        if not name in existing_genres:
+            get_action('tag_create')(dict(context), { 'name': name, 'vocabulary_id': vocab['id'] })
+
+    org_names = []
+    for i in range(num_organizations):
+        org = make_organization_dict(prefix, i)
+        try:
+            get_action('organization_show')(dict(context), { 'id': org['name'] })
+        except toolkit.ObjectNotFound:
+            get_action('organization_create')(dict(context), org)
+            log1.info('Created organization %s', org['name'])
+        org_names.append(org['name'])
+
+    rnd = random.Random(num_datasets)
+    names = []
+    for i in range(num_datasets):
+        pkg = make_dataset_dict(prefix, i, org_names, genres, num_extras, rnd)
+        try:
+            get_action('package_show')(dict(context), { 'id': pkg['name'] })
+        except toolkit.ObjectNotFound:
+            get_action('package_create')(dict(context), pkg)
+            if (i + 1) % 100 == 0:
+                log1.info('Created %d/%d datasets', i + 1, num_datasets)
+        names.append(pkg['name'])
+    return names
+
+def cleanup_catalogue(context, prefix):
+    '''Delete the datasets, organizations and synthetic genres of a synthetic catalogue'''
+    get_action = toolkit.get_action
+    session = context['session']
+
+    q = session.query(model.Package.name).filter(model.Package.name.like(prefix + '-dataset-%'))
+    names = [name for (name,) in q.filter(model.Package.state == 'active')]
+    for name in names:
+        get_action('package_delete')(dict(context), { 'id': name })
+    log1.info('Deleted %d datasets', len(names))
+
+    q = session.query(model.Group.name).filter(model.Group.name.like(prefix + '-org-%'))
+    names = [name for (name,) in q.filter(model.Group.state == 'active')]
+    for name in names:
+        get_action('organization_delete')(dict(context), { 'id': name })
+    log1.info('Deleted %d organizations', len(names))
+
+    vocab = model.Vocabulary.get('music_genres')
+    names = [tag.name for tag in vocab.tags if tag.name.startswith(prefix + '-genre-')] if vocab else []
+    for name in names:
+        get_action('tag_delete')(dict(context), { 'id': name, 'vocabulary_id': vocab.id })
+    log1.info('Deleted %d genres', len(names))
+
+def page_jobs(dataset_names, genres, num_requests, rnd=random):
+    '''Yield a (label, path) mix of read, edit and search page requests'''
+    for i in range(num_requests):
+        kind = i % 3
+        if kind == 0:
+            yield 'read', '/dataset/%s' % (rnd.choice(dataset_names))
+        elif kind == 1:
+            yield 'edit', '/dataset/edit/%s' % (rnd.choice(dataset_names))
+        else:
+            yield 'search', '/dataset?%s' % (urllib.urlencode({ 'tags': 'loadtest', 'q': rnd.choice(genres) }))
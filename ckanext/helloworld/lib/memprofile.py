@@ -0,0 +1,212 @@
+import gc
+import copy
+import json
+import time
+import logging
+import resource
+import threading
+
+try:
+    # Available on Python 3.4+, or on Python 2 through the pytracemalloc backport
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+log1 = logging.getLogger(__name__)
+
+PAGE_SIZE = resource.getpagesize()
+
+def current_rss():
+    '''Return the resident set size of this process (in bytes), None if unknown'''
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * PAGE_SIZE
+    except (IOError, ValueError, IndexError):
+        return None
+
+class RSSSampler(threading.Thread):
+    '''Sample the resident set size in the background, keeping track of its peak'''
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = self.start_rss = current_rss() or 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, current_rss() or 0)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, current_rss() or 0)
+        return self.peak - self.start_rss
+
+def _type_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        t = type(obj).__name__
+        counts[t] = counts.get(t, 0) + 1
+    return counts
+
+def trace(fn, top=10):
+    '''Run fn() under allocation tracing, return a dict with its peak memory (in bytes)
+    and its top allocation sites.
+
+    With tracemalloc, the peak is the peak of traced memory and the sites are source
+    lines. Without it, the peak is the growth of the resident set size (sampled in the
+    background) and the sites are the object types that grew the most.
+    '''
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        t0 = time.time()
+        try:
+            result = fn()
+            elapsed = time.time() - t0
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            del result
+        finally:
+            tracemalloc.stop()
+        sites = [{ 'site': str(stat.traceback), 'size': stat.size, 'count': stat.count }
+            for stat in snapshot.statistics('lineno')[:top]]
+        return { 'peak': peak, 'elapsed': elapsed, 'method': 'tracemalloc', 'top': sites }
+    else:
+        before = _type_counts()
+        sampler = RSSSampler()
+        sampler.start()
+        t0 = time.time()
+        try:
+            result = fn()
+            elapsed = time.time() - t0
+        finally:
+            peak = sampler.stop()
+        after = _type_counts()
+        del result
+        growth = sorted(((n - before.get(t, 0), t) for t, n in after.items()), reverse=True)
+        sites = [{ 'site': t, 'size': None, 'count': n } for n, t in growth[:top] if n > 0]
+        return { 'peak': peak, 'elapsed': elapsed, 'method': 'rss', 'top': sites }
+
+## Workloads ##
+
+class Workloads(object):
+    '''Representative workloads for the plugin's schemas, hooks and helpers'''
+
+    def __init__(self, plugin, context, num_datasets=500):
+        self.plugin = plugin
+        self.context = context
+        self.num_datasets = num_datasets
+
+    def _context(self):
+        context = dict(self.context)
+        # Nothing is written (e.g. the recorder must not record synthetic datasets)
+        context['helloworld.validate_only'] = True
+        return context
+
+    def validate(self):
+        '''Validate synthetic datasets against the create schema'''
+        from ckan.lib.navl.dictization_functions import validate
+        from ckanext.helloworld.lib.loadtest import make_dataset_dict
+        schema = self.plugin.create_package_schema()
+        genres = self.plugin.MUSIC_GENRES
+        return [validate(make_dataset_dict('memprofile', i, self.orgs, genres, 5), schema, self._context())
+            for i in range(self.num_datasets)]
+
+    def _stored_datasets(self):
+        import ckan.model as model
+        from ckan.lib.dictization.model_dictize import package_dictize
+        q = model.Session.query(model.Package).filter(model.Package.state == 'active')
+        return [package_dictize(pkg, self._context()) for pkg in q.limit(self.num_datasets)]
+
+    def show_schema(self):
+        '''Convert stored datasets through the show schema'''
+        from ckan.lib.navl.dictization_functions import validate
+        schema = self.plugin.show_package_schema()
+        return [validate(pkg_dict, schema, self._context()) for pkg_dict in self.datasets]
+
+    def before_view(self):
+        '''Prepare stored datasets (already converted) for view'''
+        return [self.plugin.before_view(pkg_dict) for pkg_dict in self.shown]
+
+    def organization_list_objects(self):
+        return self.plugin.organization_list_objects()
+
+    def organization_dict_objects(self):
+        return self.plugin.organization_dict_objects()
+
+    STAGES = ('validate', 'show_schema', 'before_view',
+        'organization_list_objects', 'organization_dict_objects')
+
+    def prepare(self, stages):
+        '''Prepare (i.e. outside of tracing) the inputs needed by the given stages'''
+        if 'validate' in stages:
+            self.orgs = [org['name'] for org in self.plugin.organization_list_objects()[:10]]
+        if 'show_schema' in stages or 'before_view' in stages:
+            self.datasets = self._stored_datasets()
+        if 'before_view' in stages:
+            # Note Copy here, so that the copies are not measured as part of the stage
+            self.shown = [copy.deepcopy(pkg_dict) for pkg_dict, errors in self.show_schema()]
+
+    def run(self, stages, top=10):
+        self.prepare(stages)
+        results = {}
+        for stage in stages:
+            log1.info('Profiling stage %s', stage)
+            results[stage] = trace(getattr(self, stage), top)
+        return results
+
+## Reporting ##
+
+def format_size(n):
+    if n is None:
+        return '-'
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(n) < 1024:
+            return '%.1f%s' % (n, unit)
+        n /= 1024.0
+    return '%.1fGiB' % (n)
+
+def compare(results, baseline, tolerance=0.1):
+    '''Compare peaks against a baseline, return a list of (stage, peak, base, ratio, regressed)'''
+    rows = []
+    for stage, r in sorted(results.items()):
+        base = baseline.get(stage, {}).get('peak')
+        ratio = float(r['peak']) / base if base else None
+        rows.append((stage, r['peak'], base, ratio, ratio is not None and ratio > 1 + tolerance))
+    return rows
+
+def format_report(results, baseline=None, tolerance=0.1):
+    lines = []
+    for stage, peak, base, ratio, regressed in compare(results, baseline or {}, tolerance):
+        r = results[stage]
+        line = '%-26s peak=%-10s time=%.2fs' % (stage, format_size(peak), r['elapsed'])
+        if base is not None:
+            line += ' baseline=%-10s %+.1f%%%s' % (
+                format_size(base), (ratio - 1) * 100, ' REGRESSION' if regressed else '')
+        lines.append(line)
+        for site in r['top']:
+            lines.append('    %10s %8d  %s' % (format_size(site['size']), site['count'], site['site']))
+    return '\n'.join(lines)
+
+def load_baseline(path, method, num_datasets):
+    '''Load the per-stage results of a baseline, refusing (with a ValueError) one
+    that was measured by another method or on workloads of another size'''
+    with open(path) as fp:
+        baseline = json.load(fp)
+    if not isinstance(baseline, dict) or not 'stages' in baseline:
+        raise ValueError('Not a baseline (or saved by an older version): %s' % (path))
+    if baseline.get('method') != method:
+        raise ValueError('The baseline was measured by %s, not %s' % (baseline.get('method'), method))
+    if baseline.get('num_datasets') != num_datasets:
+        raise ValueError('The baseline was measured on %s datasets, not %s' % (
+            baseline.get('num_datasets'), num_datasets))
+    return baseline['stages']
+
+def save_baseline(path, results, method, num_datasets):
+    baseline = { 'method': method, 'num_datasets': num_datasets, 'stages': results }
+    with open(path, 'w') as fp:
+        json.dump(baseline, fp, indent=2, sort_keys=True)
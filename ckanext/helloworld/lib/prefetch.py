@@ -0,0 +1,167 @@
+import time
+import logging
+import threading
+import Queue
+
+import pylons
+import routes
+
+import ckan.model as model
+
+log1 = logging.getLogger(__name__)
+
+# The (Paste-registered) thread-locals of a Pylons request
+REQUEST_LOCALS = ('request', 'response', 'session', 'tmpl_context', 'translator', 'url', 'app_globals')
+
+def capture_request_locals():
+    '''Capture the Pylons and Routes thread-locals of the current request, so that they
+    can be installed in a worker (e.g. URLs are built from them, as h.url_for_static does)
+    '''
+    objects = []
+    for name in REQUEST_LOCALS:
+        proxy = getattr(pylons, name, None)
+        if proxy is None:
+            continue
+        try:
+            objects.append((proxy, proxy._current_obj()))
+        except (TypeError, AttributeError):
+            # Not registered (e.g. not inside a request)
+            pass
+    config = routes.request_config()
+    return objects, getattr(config, 'mapper', None), getattr(config, 'environ', None)
+
+def _install_request_locals(request_locals):
+    objects, mapper, environ = request_locals
+    for proxy, obj in objects:
+        proxy._push_object(obj)
+    if mapper is not None:
+        config = routes.request_config()
+        config.mapper = mapper
+        config.environ = environ
+
+def _uninstall_request_locals(request_locals):
+    objects, mapper, environ = request_locals
+    for proxy, obj in reversed(objects):
+        proxy._pop_object(obj)
+    if mapper is not None:
+        config = routes.request_config()
+        for name in ('mapper', 'environ', 'mapper_dict', 'host', 'protocol', 'redirect'):
+            try:
+                delattr(config, name)
+            except AttributeError:
+                pass
+
+class _Task(object):
+
+    def __init__(self, fn, args, request_locals):
+        self.fn = fn
+        self.args = args
+        self.request_locals = request_locals
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout):
+        self._done.wait(timeout)
+        return self.done
+
+    def run(self):
+        if self.cancelled:
+            # No one waits for it anymore
+            return
+        try:
+            _install_request_locals(self.request_locals)
+            try:
+                self.result = self.fn(*self.args)
+            finally:
+                _uninstall_request_locals(self.request_locals)
+        except Exception as ex:
+            self.error = ex
+        finally:
+            # Every worker has its own (scoped) session: release its connection
+            model.Session.remove()
+            self._done.set()
+
+class WorkerPool(object):
+    '''A fixed number of (daemon) threads running tasks from a queue.
+
+    The threads are started on the first task (i.e. after any fork of the worker
+    processes). At most max_pending tasks may be waiting: further ones are refused.
+    '''
+
+    def __init__(self, size=2, max_pending=None):
+        self.size = size
+        self.max_pending = max_pending if max_pending is not None else 4 * size
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, task):
+        '''Queue a task, return False if it was refused'''
+        if self._queue.qsize() >= self.max_pending:
+            return False
+        with self._lock:
+            if not self._threads:
+                for i in range(self.size):
+                    t = threading.Thread(target=self._work, name='helloworld-prefetch-%d' % (i))
+                    t.daemon = True
+                    t.start()
+                    self._threads.append(t)
+        self._queue.put(task)
+        return True
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            task.run()
+
+class Prefetch(object):
+    '''Start lookups on a (shared) pool of workers, and hand their results over when asked for.
+
+    If a lookup has failed, or has not completed within the timeout (or was refused
+    by a busy pool), the caller's fallback (i.e. the synchronous path) is used instead.
+    '''
+
+    def __init__(self, pool, timeout=2.0):
+        self.pool = pool
+        self.timeout = timeout
+        self._tasks = {}
+        self._request_locals = None
+
+    def start(self, name, fn, *args):
+        if self._request_locals is None:
+            self._request_locals = capture_request_locals()
+        task = _Task(fn, args, self._request_locals)
+        if self.pool.submit(task):
+            self._tasks[name] = task
+        else:
+            log1.debug('Prefetch of %s refused: the pool is busy', name)
+
+    def result(self, name):
+        '''Wait (up to the timeout) for a lookup, return (True, result) or (False, None)'''
+        task = self._tasks.get(name)
+        if task is None or task.cancelled:
+            return False, None
+        t0 = time.time()
+        if not task.wait(self.timeout):
+            task.cancelled = True
+            log1.warn('Prefetch of %s timed out after %.2fs', name, time.time() - t0)
+            return False, None
+        if task.error is not None:
+            log1.warn('Prefetch of %s failed: %s', name, task.error)
+            return False, None
+        return True, task.result
+
+    def get(self, name, fallback, *args):
+        '''Return the result of a lookup started with the same args, else fallback(*args)'''
+        task = self._tasks.get(name)
+        if task is not None and task.args == args:
+            ok, result = self.result(name)
+            if ok:
+                return result
+        return fallback(*args)
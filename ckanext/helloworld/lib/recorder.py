@@ -0,0 +1,78 @@
+import os
+import time
+import json
+import random
+import logging
+
+log1 = logging.getLogger(__name__)
+
+KINDS = ('create', 'update', 'search', 'show')
+
+class TrafficRecorder(object):
+    '''Append (a sample of) the inputs reaching the plugin's hooks to a local log.
+
+    The log is a JSON-lines file, each line being {"t": <time>, "k": <kind>, "d": <data>}.
+    Each record is emitted with a single write on a file opened for appending, so that
+    several worker processes may safely share the same log.
+    '''
+
+    def __init__(self, path, sample_rate=1.0):
+        self.path = path
+        self.sample_rate = float(sample_rate)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+    def record(self, kind, data):
+        assert kind in KINDS, 'Unknown kind of record: %s' % (kind)
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        try:
+            line = json.dumps({ 't': time.time(), 'k': kind, 'd': data },
+                separators=(',', ':'), default=repr)
+            os.write(self._fd, line + '\n')
+        except Exception as ex:
+            # Never let the recorder break the request it observes
+            log1.warn('Failed to record a %s: %s', kind, ex)
+
+    def close(self):
+        os.close(self._fd)
+
+def read_log(path, kinds=KINDS):
+    '''Iterate over the (well-formed) records of a log, as (time, kind, data) tuples'''
+    with open(path) as fp:
+        for n, line in enumerate(fp):
+            try:
+                r = json.loads(line)
+            except ValueError:
+                log1.warn('Skipping malformed record at line %d', n + 1)
+                continue
+            if r.get('k') in kinds:
+                yield r['t'], r['k'], r['d']
+
+def replay_jobs(records, speed=1.0):
+    '''Yield (kind, data) jobs from recorded (time, kind, data) records, paced to reproduce
+    the recorded inter-arrival times scaled by 1/speed (a speed of 0 means no pacing).
+    '''
+    t0 = started_at = None
+    for t, kind, data in records:
+        if speed > 0:
+            if t0 is None:
+                t0, started_at = t, time.time()
+            delay = started_at + (t - t0) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        yield kind, data
+
+def replay_record(client, kind, data):
+    '''Re-issue a recorded input as the action api call that originally carried it.
+    Return the HTTP status of the call.
+    '''
+    if kind == 'create':
+        status, result = client.action('package_create', data)
+    elif kind == 'update':
+        status, result = client.action('package_update', data)
+    elif kind == 'search':
+        params = dict((k, v) for k, v in data.items() if v or v == 0)
+        status, result = client.action('package_search', params)
+    elif kind == 'show':
+        status, result = client.action('package_show', { 'id': data.get('id') })
+    return status
@@ -0,0 +1,175 @@
+import time
+import datetime
+import logging
+import threading
+
+from sqlalchemy import orm
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+log1 = logging.getLogger(__name__)
+
+VOCABULARY = 'music_genres'
+
+## Operations on the list of genres of a dataset ##
+
+def set_genre(name):
+    return lambda genres: [name]
+
+def rename_genre(old, new):
+    def rename(genres):
+        result = []
+        for g in genres:
+            g = new if g == old else g
+            if not g in result:
+                result.append(g)
+        return result
+    return rename
+
+def remove_genre(name):
+    return lambda genres: [g for g in genres if g != name]
+
+class RateLimiter(object):
+    '''A (thread-safe) limiter of the rate at which datasets are processed'''
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def acquire(self, n=1):
+        if not self.rate > 0:
+            return
+        with self._lock:
+            now = time.time()
+            t = max(now, self._next)
+            self._next = t + n / self.rate
+        if t > now:
+            time.sleep(t - now)
+
+def search_package_ids(q='*:*', organization=None, page_size=1000):
+    '''Return the ids of the datasets matching a query (and an organization).
+
+    All ids are collected before any batch is processed: the batches re-index the
+    datasets they change, so paging (by offset) while they run would skip results.
+    '''
+    from ckan.lib.search import query_for
+
+    fq = ''
+    if organization:
+        org = model.Group.get(organization)
+        if not org:
+            raise toolkit.ObjectNotFound('No such organization: %s' % (organization))
+        fq = '+owner_org:"%s"' % (org.id)
+    query = query_for(model.Package)
+    package_ids = []
+    while True:
+        query.run({ 'q': q, 'fq': fq, 'fl': 'id', 'sort': 'id asc',
+            'rows': page_size, 'start': len(package_ids) })
+        if not query.results:
+            break
+        package_ids.extend(query.results)
+    return package_ids
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class Retagger(object):
+    '''Apply an operation on the music genres of batches of datasets.
+
+    Each batch is applied directly on the package-tag associations under a single
+    revision and commit (instead of a package_update per dataset), and then the
+    changed datasets are re-indexed. As a package_update would, this bumps the
+    metadata_modified and the revision stamps of the changed datasets. Batches may
+    be processed by several threads, each using its own (thread-local) session.
+    '''
+
+    def __init__(self, operation, user, dry_run=False, rate_limiter=None):
+        self.operation = operation
+        self.user = user
+        self.dry_run = dry_run
+        self.rate_limiter = rate_limiter
+        self.vocabulary_id = model.Vocabulary.get(VOCABULARY).id
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.changed = 0
+        self.diffs = []
+
+    def ensure_tags(self, names):
+        '''Create any of the given genres missing from the vocabulary, return the created ones'''
+        existing = set(t.name for t in model.Session.query(model.Tag).filter(
+            model.Tag.vocabulary_id == self.vocabulary_id))
+        context = {'model': model, 'session': model.Session, 'user': self.user}
+        created = []
+        for name in names:
+            if not name in existing:
+                toolkit.get_action('tag_create')(dict(context),
+                    { 'name': name, 'vocabulary_id': self.vocabulary_id })
+                created.append(name)
+        return created
+
+    def __call__(self, package_ids):
+        '''Process a batch of datasets, return True if it succeeded'''
+        if self.rate_limiter:
+            self.rate_limiter.acquire(len(package_ids))
+
+        from ckan.lib import search
+        from ckanext.helloworld.plugins import DatasetForm
+
+        session = model.Session
+        tags = dict((t.name, t) for t in session.query(model.Tag).filter(
+            model.Tag.vocabulary_id == self.vocabulary_id))
+        diffs = []
+        try:
+            if not self.dry_run:
+                rev = model.repo.new_revision()
+                rev.author = self.user
+                rev.message = u'Re-tagged music genres'
+            q = session.query(model.Package).filter(model.Package.id.in_(package_ids))
+            q = q.options(orm.joinedload_all('package_tag_all.tag'), orm.joinedload('_extras'))
+            for pkg in q:
+                package_tags = [pt for pt in pkg.package_tag_all if pt.tag.vocabulary_id == self.vocabulary_id]
+                current = [pt.tag.name for pt in package_tags if pt.state == 'active']
+                genres = self.operation(current)
+                if genres == current:
+                    continue
+                diffs.append((pkg.name, current, genres))
+                if self.dry_run:
+                    continue
+                for pt in package_tags:
+                    pt.state = 'active' if pt.tag.name in genres else 'deleted'
+                existing = set(pt.tag.name for pt in package_tags)
+                for name in genres:
+                    if not name in existing:
+                        session.add(model.PackageTag(package=pkg, tag=tags[name], state='active'))
+                pkg.metadata_modified = datetime.datetime.utcnow()
+                revision, datestamp = DatasetForm.revision_stamps(pkg.extras.get('record_revision'))
+                pkg.extras['record_revision'] = revision
+                pkg.extras['record_modified_at'] = datestamp
+            if diffs and not self.dry_run:
+                model.repo.commit()
+                for name, current, genres in diffs:
+                    search.rebuild(name, defer_commit=True)
+                search.commit()
+        except Exception as ex:
+            log1.error('Failed to re-tag a batch of %d datasets: %s', len(package_ids), ex)
+            session.rollback()
+            return False
+        finally:
+            model.Session.remove()
+
+        with self._lock:
+            self.processed += len(package_ids)
+            self.changed += len(diffs)
+            if self.dry_run:
+                self.diffs.extend(diffs)
+            log1.info('Processed %d datasets (%d changed)', self.processed, self.changed)
+        return True
@@ -0,0 +1,146 @@
+import os
+import re
+import copy
+import time
+import json
+import mmap
+import fcntl
+import struct
+import logging
+import threading
+
+log1 = logging.getLogger(__name__)
+
+class SharedCache(object):
+    '''A cache shared by all (worker) processes on the same host.
+
+    Every entry lives in its own memory-mapped file, under a common directory:
+
+        | seq (Q) | version (Q) | stamp (d) | length (Q) | payload (JSON) ... |
+
+    The header is protected by a sequence lock: a writer (holding an exclusive
+    flock on the file) makes seq odd, updates payload and the rest of the header,
+    and only then makes seq even again. A reader retries until it sees the same
+    even seq before and after reading. Each write or invalidation bumps the version,
+    so that a reader only decodes the payload when the version differs from the one
+    it last decoded; otherwise it returns a copy of its already decoded value (so
+    that callers may modify what they get). An invalidation is a write of an empty
+    (length 0) payload.
+    '''
+
+    HEADER = struct.Struct('=QQdQ')
+
+    # The parts of the header a writer updates separately: seq, and what follows it
+    SEQ = struct.Struct('=Q')
+    FIELDS = struct.Struct('=QdQ')
+
+    MIN_SIZE = 4096
+
+    # Give up (i.e. report a miss) if a write seems to never complete
+    MAX_RETRIES = 1000
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self._maps = {}     # key -> (fd, mmap)
+        self._decoded = {}  # key -> (version, value)
+
+    def _filename(self, key):
+        return os.path.join(self.path, re.sub(r'[^a-zA-Z0-9_.-]', '_', key) + '.cache')
+
+    def _map(self, key, size=0):
+        '''Return the (fd, mmap) of a key, (re)mapping it if the file was grown.
+        A non-zero size grows the file, so it must only be requested while holding its flock.
+        Return (fd, None) if the file has not been initialized by a writer yet.
+        '''
+        fd, m = self._maps.get(key, (None, None))
+        if fd is None:
+            fd = os.open(self._filename(key), os.O_RDWR | os.O_CREAT, 0644)
+            self._maps[key] = (fd, None)
+        file_size = os.fstat(fd).st_size
+        if size and file_size < size:
+            file_size = max(self.MIN_SIZE, 2 * size)
+            os.ftruncate(fd, file_size)
+        elif file_size < self.HEADER.size:
+            return fd, None
+        if m is None or len(m) < file_size:
+            if m is not None:
+                m.close()
+            m = mmap.mmap(fd, file_size)
+        self._maps[key] = (fd, m)
+        return fd, m
+
+    def get(self, key):
+        '''Return the cached value for key, or None if missing (or expired or invalidated)'''
+        with self._lock:
+            fd, m = self._map(key)
+            if m is None:
+                return None
+            for i in xrange(self.MAX_RETRIES):
+                seq, version, stamp, length = self.HEADER.unpack_from(m, 0)
+                if seq % 2:
+                    # A write is in progress
+                    time.sleep(0.001 if i > 10 else 0)
+                    continue
+                decoded = self._decoded.get(key)
+                if decoded and decoded[0] == version:
+                    value = decoded[1]
+                elif not length:
+                    value = None
+                else:
+                    end = self.HEADER.size + length
+                    if end > len(m):
+                        fd, m = self._map(key)
+                        continue
+                    payload = m[self.HEADER.size:end]
+                    if self.HEADER.unpack_from(m, 0)[0] != seq:
+                        continue
+                    try:
+                        value = json.loads(payload)
+                    except ValueError:
+                        log1.warn('Failed to decode shared cache entry %s', key)
+                        return None
+                    self._decoded[key] = (version, value)
+                if self.HEADER.unpack_from(m, 0)[0] == seq:
+                    break
+            else:
+                log1.warn('Gave up reading shared cache entry %s', key)
+                return None
+        if value is not None and self.ttl and time.time() - stamp > self.ttl:
+            return None
+        return copy.deepcopy(value)
+
+    def _write(self, key, payload):
+        with self._lock:
+            fd, m = self._map(key)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                fd, m = self._map(key, self.HEADER.size + max(len(payload), 1))
+                seq, version, stamp, length = self.HEADER.unpack_from(m, 0)
+                self.SEQ.pack_into(m, 0, seq + 1)
+                m[self.HEADER.size:self.HEADER.size + len(payload)] = payload
+                # Note Publish the (even) seq last, after version, stamp and length are in place
+                self.FIELDS.pack_into(m, self.SEQ.size, version + 1, time.time(), len(payload))
+                self.SEQ.pack_into(m, 0, seq + 2)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._decoded.pop(key, None)
+
+    def set(self, key, value):
+        self._write(key, json.dumps(value, separators=(',', ':')))
+
+    def invalidate(self, key):
+        '''Invalidate an entry for all processes'''
+        self._write(key, '')
+
+    def get_or_compute(self, key, compute):
+        '''Return the cached value for key, computing (and sharing) it on a miss'''
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.set(key, value)
+        return value
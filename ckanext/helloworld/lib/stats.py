@@ -0,0 +1,201 @@
+import csv
+import json
+import time
+import heapq
+import datetime
+import logging
+
+import ckan.model as model
+
+log1 = logging.getLogger(__name__)
+
+class TopCounter(object):
+    '''Count values of a stream within bounded memory (the "space-saving" algorithm).
+
+    At most `capacity` values are tracked. While there are fewer distinct values than
+    that, counts are exact; otherwise the count of a value may be overestimated by at
+    most its reported error.
+    '''
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        # A min-heap of (count, value): an entry is stale if its count is not the current one
+        self._heap = []
+
+    def add(self, value, n=1):
+        self.total += n
+        if value in self.counts:
+            c = self.counts[value] = self.counts[value] + n
+        elif len(self.counts) < self.capacity:
+            c = self.counts[value] = n
+            self.errors[value] = 0
+        else:
+            # Evict the least frequent value, the newcomer inherits its count
+            victim = self._pop_min()
+            c = self.counts.pop(victim)
+            self.errors.pop(victim)
+            self.counts[value] = c + n
+            self.errors[value] = c
+            c += n
+        heapq.heappush(self._heap, (c, value))
+        if len(self._heap) > 4 * self.capacity:
+            # Drop the stale entries
+            self._heap = [(c, v) for v, c in self.counts.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            c, value = heapq.heappop(self._heap)
+            if self.counts.get(value) == c:
+                return value
+
+    def exact(self):
+        return not any(self.errors.values())
+
+    def most_common(self):
+        return sorted(self.counts.items(), key=lambda t: (-t[1], t[0]))
+
+    def error(self, value):
+        '''Return the max overestimation of the count of a (tracked) value'''
+        return self.errors.get(value, 0)
+
+class Histogram(object):
+    '''Count values into fixed buckets, given as (label, upper bound) in increasing order'''
+
+    def __init__(self, buckets, overflow_label, invalid_label='invalid'):
+        self.buckets = buckets
+        self.overflow_label = overflow_label
+        self.invalid_label = invalid_label
+        self.counts = dict((label, 0) for label, bound in buckets)
+        self.counts[overflow_label] = self.counts[invalid_label] = 0
+
+    def add(self, value):
+        if value is None:
+            label = self.invalid_label
+        else:
+            label = self.overflow_label
+            for l, bound in self.buckets:
+                if value < bound:
+                    label = l
+                    break
+        self.counts[label] += 1
+
+    def items(self):
+        labels = [label for label, bound in self.buckets] + [self.overflow_label, self.invalid_label]
+        return [(label, self.counts[label]) for label in labels]
+
+DAY = 86400.0
+
+AGE_BUCKETS = [('<1d', 1 * DAY), ('<7d', 7 * DAY), ('<30d', 30 * DAY), ('<90d', 90 * DAY), ('<365d', 365 * DAY)]
+
+def parse_age(value, now):
+    '''Return the age (in seconds) of a record_modified_at stamp, None if unparsable'''
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            t = datetime.datetime.strptime(value, fmt)
+        except (ValueError, TypeError):
+            continue
+        return now - time.mktime(t.timetuple())
+    return None
+
+class CatalogueStats(object):
+    '''Compute statistics on the (active) datasets by streaming over the database.
+
+    The dimensions are computed by three streaming queries (fetched in chunks, one
+    pass each: organizations, genres and extras) and aggregated into bounded
+    structures, so memory use does not grow with the size of the catalogue.
+    Counts of the bounded (top) dimensions are reported with their error bounds.
+    '''
+
+    def __init__(self, capacity=1000, chunk_size=1000):
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.num_datasets = 0
+        self.genres = TopCounter(capacity)
+        self.organizations = TopCounter(capacity)
+        self.foo_x1 = TopCounter(capacity)
+        self.music_title_filled = 0
+        self.record_age = Histogram(AGE_BUCKETS, '>=365d')
+
+    def _stream(self, q):
+        # Use a server-side cursor (where supported), so that rows are not buffered all at once
+        return q.execution_options(stream_results=True).yield_per(self.chunk_size)
+
+    def compute(self):
+        session = model.Session
+        Package, PackageExtra = model.Package, model.PackageExtra
+        active = (Package.state == 'active')
+
+        for owner_org, name in self._stream(session.query(Package.owner_org, model.Group.name)
+                .outerjoin(model.Group, model.Group.id == Package.owner_org).filter(active)):
+            self.num_datasets += 1
+            self.organizations.add(name or owner_org or '')
+
+        for name, in self._stream(session.query(model.Tag.name)
+                .join(model.PackageTag, model.PackageTag.tag_id == model.Tag.id)
+                .join(Package, Package.id == model.PackageTag.package_id)
+                .join(model.Vocabulary, model.Vocabulary.id == model.Tag.vocabulary_id)
+                .filter(model.Vocabulary.name == 'music_genres')
+                .filter(model.PackageTag.state == 'active').filter(active)):
+            self.genres.add(name)
+
+        now = time.time()
+        for key, value in self._stream(session.query(PackageExtra.key, PackageExtra.value)
+                .join(Package, Package.id == PackageExtra.package_id)
+                .filter(PackageExtra.key.in_(['foo.x1', 'music_title', 'record_modified_at']))
+                .filter(PackageExtra.state == 'active').filter(active)):
+            if key == 'foo.x1':
+                self.foo_x1.add(value or '')
+            elif key == 'music_title':
+                if value:
+                    self.music_title_filled += 1
+            else:
+                self.record_age.add(parse_age(value, now))
+
+        model.Session.remove()
+        return self
+
+    def _counters(self):
+        return (('music_genre', self.genres), ('organization', self.organizations), ('foo.x1', self.foo_x1))
+
+    def rows(self):
+        '''Yield the results as (dimension, value, count, error) rows. The count of a value
+        is at most error over its true count (the error is 0 for exact counts).'''
+        yield 'datasets', '', self.num_datasets, 0
+        yield 'music_title', 'filled', self.music_title_filled, 0
+        yield 'music_title', 'fill_rate', (
+            float(self.music_title_filled) / self.num_datasets if self.num_datasets else 0.0), 0
+        for dimension, counter in self._counters():
+            for value, count in counter.most_common():
+                yield dimension, value, count, counter.error(value)
+        for label, count in self.record_age.items():
+            yield 'record_modified_at_age', label, count, 0
+
+    def as_dict(self):
+        return {
+            'datasets': self.num_datasets,
+            'music_title': {
+                'filled': self.music_title_filled,
+                'fill_rate': float(self.music_title_filled) / self.num_datasets if self.num_datasets else 0.0,
+            },
+            'music_genre': dict(self.genres.most_common()),
+            'organization': dict(self.organizations.most_common()),
+            'foo.x1': dict(self.foo_x1.most_common()),
+            'record_modified_at_age': dict(self.record_age.items()),
+            'exact': all(c.exact() for dimension, c in self._counters()),
+            # The max overestimation of each (non-exact) count above
+            'errors': dict((dimension, dict((v, e) for v, e in c.errors.items() if e))
+                for dimension, c in self._counters()),
+        }
+
+    def write_csv(self, fp):
+        writer = csv.writer(fp)
+        writer.writerow(['dimension', 'value', 'count', 'error'])
+        for dimension, value, count, error in self.rows():
+            writer.writerow([dimension, unicode(value).encode('utf-8'), count, error])
+
+    def write_json(self, fp):
+        json.dump(self.as_dict(), fp, indent=2, sort_keys=True)
@@ -0,0 +1,133 @@
+import copy
+import logging
+
+from sqlalchemy import or_, orm
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+import ckan.lib.plugins as lib_plugins
+from ckan.lib.navl.dictization_functions import validate, missing, Invalid
+
+log1 = logging.getLogger(__name__)
+
+_t = toolkit._
+
+def memoize_validator(validator):
+    '''Wrap a (key, data, errors, context) validator so that its outcome is computed once
+    per distinct (non-empty string) input value. This is only meant for validators whose
+    outcome for such values depends on nothing but the value and the (shared) context,
+    e.g. the owner_org lookup.
+    '''
+    memo = {}
+    def memoized(key, data, errors, context):
+        value = data.get(key)
+        if not value or not isinstance(value, basestring):
+            return validator(key, data, errors, context)
+        outcome = memo.get(value)
+        if outcome is None:
+            try:
+                validator(key, data, errors, context)
+            except Invalid as ex:
+                memo[value] = ('invalid', ex)
+                raise
+            memo[value] = ('valid', data.get(key, missing))
+            return
+        status, result = outcome
+        if status == 'invalid':
+            raise result
+        if result is missing:
+            data.pop(key, None)
+        else:
+            data[key] = result
+    return memoized
+
+def _batch_schema(schema):
+    '''Adapt a (freshly built) schema for use across a batch'''
+    owner_org_validator = toolkit.get_validator('owner_org_validator')
+    validators = schema.get('owner_org')
+    if validators:
+        schema['owner_org'] = [memoize_validator(v) if v is owner_org_validator else v
+            for v in validators]
+    return schema
+
+def package_validate_many(context, data_dict):
+    '''Validate a batch of datasets against the create (or update) schema, without
+    creating or updating anything.
+
+    The schema is built once per dataset type, and the shared lookups (the music
+    genres vocabulary, the organizations and the datasets to be updated) are done
+    once for the whole batch.
+
+    :param datasets: the dataset dicts to validate
+    :type datasets: list of dicts
+    :param schema: the schema to validate against: ``'create'`` (default) or ``'update'``
+        (only for datasets the user may update)
+    :type schema: string
+
+    :returns: a list with a ``{'valid': ..., 'errors': ...}`` dict per dataset, in order
+    :rtype: list of dicts
+    '''
+    toolkit.check_access('package_validate_many', context, data_dict)
+
+    datasets = data_dict.get('datasets')
+    if not isinstance(datasets, list) or not all(isinstance(d, dict) for d in datasets):
+        raise toolkit.ValidationError({ 'datasets': [_t('Must be a list of dataset dicts')] })
+    kind = data_dict.get('schema', 'create')
+    if not kind in ('create', 'update'):
+        raise toolkit.ValidationError({ 'schema': [_t('Must be either "create" or "update"')] })
+
+    session = context['session']
+
+    # Shared lookups (once per batch)
+
+    shared_context = dict(context)
+    shared_context['helloworld.validate_only'] = True
+    vocab = model.Vocabulary.get('music_genres')
+    if vocab:
+        shared_context['helloworld.vocabulary'] = (vocab.id, set(tag.name for tag in vocab.tags))
+
+    packages = {}
+    if kind == 'update':
+        refs = [d.get('id') or d.get('name') for d in datasets]
+        refs = [ref for ref in refs if ref]
+        if refs:
+            q = session.query(model.Package).filter(
+                or_(model.Package.id.in_(refs), model.Package.name.in_(refs)))
+            # Note Load the extras and tags (compared by our schema) of all packages at once
+            q = q.options(orm.subqueryload('_extras'), orm.subqueryload_all('package_tag_all.tag.vocabulary'))
+            for pkg in q:
+                packages[pkg.id] = packages[pkg.name] = pkg
+
+    schemas = {}
+
+    # Validate each dataset
+
+    results = []
+    for dataset in datasets:
+        package_type = dataset.get('type')
+        if not package_type in schemas:
+            plugin = lib_plugins.lookup_package_plugin(package_type)
+            schema = plugin.update_package_schema() if kind == 'update' else plugin.create_package_schema()
+            schemas[package_type] = _batch_schema(schema)
+
+        item_context = dict(shared_context)
+        if kind == 'update':
+            pkg = packages.get(dataset.get('id')) or packages.get(dataset.get('name'))
+            if pkg:
+                # Note Only validate against datasets the user may edit: report the others
+                # as not found, so that (e.g. private) datasets cannot be probed
+                item_context['package'] = pkg
+                try:
+                    toolkit.check_access('package_update', item_context, { 'id': pkg.id })
+                except toolkit.NotAuthorized:
+                    pkg = None
+            if not pkg:
+                results.append({ 'valid': False, 'errors': { 'id': [_t('Not found')] } })
+                continue
+
+        data, errors = validate(copy.deepcopy(dataset), schemas[package_type], item_context)
+        results.append({ 'valid': not errors, 'errors': errors })
+
+    log1.debug('package_validate_many: %d of %d datasets are valid',
+        len(filter(lambda r: r['valid'], results)), len(results))
+    return results
@@ -0,0 +1,9 @@
+import ckan.plugins.toolkit as toolkit
+
+def package_validate_many(context, data_dict):
+    '''Anyone allowed to create datasets may validate them in bulk'''
+    try:
+        toolkit.check_access('package_create', context, {})
+    except toolkit.NotAuthorized:
+        return { 'success': False, 'msg': toolkit._('Not authorized to validate datasets') }
+    return { 'success': True }
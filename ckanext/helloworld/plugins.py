@@ -2,9 +2,13 @@
 
 import json
 import time
+import datetime
 import jsonpickle
 import copy
 import logging
+import threading
+import tempfile
+import os.path
 
 import ckan.model           as model
 import ckan.plugins         as p
@@ -13,6 +17,11 @@ import ckan.logic           as logic
 
 import weberror
 
+from ckanext.helloworld.lib.recorder import TrafficRecorder
+from ckanext.helloworld.lib.shared_cache import SharedCache
+from ckanext.helloworld.lib.conditional import ConditionalGetMiddleware
+from ckanext.helloworld.lib.prefetch import Prefetch, WorkerPool
+
 _t = toolkit._
 
 log1 = logging.getLogger(__name__)
@@ -26,11 +35,35 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
     p.implements(p.IConfigurer, inherit=True)
     p.implements(p.IDatasetForm, inherit=True)
     p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IMiddleware, inherit=True)
+    p.implements(p.IActions)
+    p.implements(p.IAuthFunctions)
 
     ## helper methods ## 
 
     MUSIC_GENRES = ['classical', 'rock', 'pop', 'heavy-metal', 'jazz', 'ethnic',]
 
+    # Number of field conversions skipped on updates, because the submitted value
+    # was equal to the stored one (see music_title_unchanged, music_genre_unchanged)
+    skipped_conversions = 0
+
+    # An (opt-in) recorder of the inputs reaching our hooks and schemas
+    recorder = None
+
+    # An (opt-in) cache for vocabulary and organization data, shared by all workers on this host
+    shared_cache = None
+
+    # The last revision stamp handed out by this process (see next_revision)
+    _last_revision = 0
+    _revision_lock = threading.Lock()
+
+    # Max time (in seconds) the helpers wait for lookups prefetched at request start
+    # (see setup_template_variables), before falling back to a synchronous lookup
+    prefetch_timeout = 2.0
+
+    # The (per-process) pool of workers running the prefetched lookups
+    prefetch_pool = None
+
     @classmethod
     def create_music_genres(cls):
         '''Create music genres vocabulary and tags, if they don't exist already.
@@ -51,10 +84,34 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
                 log1.info("Adding tag {0} to vocab 'music_genres'".format(tag))
                 data = {'name': tag, 'vocabulary_id': vocab['id']}
                 toolkit.get_action ('tag_create') (context, data)
+            if cls.shared_cache:
+                cls.shared_cache.invalidate('music_genres')
+
+    @classmethod
+    def _prefetch(cls):
+        ''' Return the prefetched lookups of the current request, if any '''
+        try:
+            return getattr(toolkit.c, 'helloworld_prefetch', None) or None
+        except TypeError:
+            # Not inside a request (no template context is registered)
+            return None
 
     @classmethod
     def music_genres(cls):
         '''Return the list of all existing genres from the music_genres vocabulary.'''
+        prefetch = cls._prefetch()
+        if prefetch:
+            return prefetch.get('music_genres', cls._lookup_music_genres)
+        return cls._lookup_music_genres()
+
+    @classmethod
+    def _lookup_music_genres(cls):
+        if cls.shared_cache:
+            return cls.shared_cache.get_or_compute('music_genres', cls._music_genres)
+        return cls._music_genres()
+
+    @classmethod
+    def _music_genres(cls):
         cls.create_music_genres()
         try:
             music_genres = toolkit.get_action ('tag_list') (data_dict={ 'vocabulary_id': 'music_genres'})
@@ -68,6 +125,26 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
         for name in cls.music_genres():
             yield { 'value': name, 'text': name }
 
+    @classmethod
+    def next_revision(cls, previous=0):
+        '''Return a new revision stamp (in microseconds since the epoch) for a dataset.
+        Stamps are strictly increasing, both for a dataset (i.e. greater than its previous
+        stamp) and within this process, even if the clock goes backwards.
+        '''
+        with cls._revision_lock:
+            revision = max(int(time.time() * 1e6), previous + 1, cls._last_revision + 1)
+            cls._last_revision = revision
+        return revision
+
+    @classmethod
+    def revision_stamps(cls, previous=None):
+        '''Return the values of the (new) "record_revision" and "record_modified_at"
+        extras of a dataset, given its previous "record_revision" (if any).
+        '''
+        revision = cls.next_revision(int(previous) if previous else 0)
+        datestamp = datetime.datetime.fromtimestamp(revision / 1e6).strftime('%Y-%m-%dT%H:%M:%S.%f')
+        return str(revision), datestamp
+
     @classmethod
     def hello_world(cls):
         ''' This is our simple helper function. '''
@@ -75,12 +152,35 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
         return p.toolkit.literal(html)
 
     @classmethod
-    def organization_list_objects(cls, org_names = []):
+    def organizations_available(cls, permission='create_dataset', user=None):
+        ''' Return the organizations the (current) user has a permission for, as the
+        core organizations_available helper does, but using the prefetched lookup if any. '''
+        if user is None:
+            prefetch = cls._prefetch()
+            if prefetch:
+                ok, result = prefetch.result('organizations')
+                if ok and result[0] == permission:
+                    return result[1]
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': user or toolkit.c.user,
+        }
+        return logic.get_action('organization_list_for_user') (context, { 'permission': permission })
+
+    @classmethod
+    def _organizations_with_objects(cls, user, permission):
+        ''' Lookup (e.g. in the background) the data for the organization widget of the dataset form '''
+        orgs = cls.organizations_available(permission, user=user)
+        return permission, orgs, cls.organization_dict_objects(orgs, user=user)
+
+    @classmethod
+    def organization_list_objects(cls, org_names = [], user = None):
         ''' Make a action-api call to fetch the a list of full dict objects (for each organization) '''
         context = {
             'model': model,
             'session': model.Session,
-            'user': toolkit.c.user,
+            'user': user or toolkit.c.user,
         }
 
         options = { 'all_fields': True }
@@ -91,13 +191,28 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
             elif t is dict:
                 options['organizations'] = map(lambda org: org.get('name'), org_names)
 
+        if cls.shared_cache:
+            # Share a single entry with all organizations, and filter it here (instead of
+            # an entry per distinct set of names)
+            orgs = cls.shared_cache.get_or_compute('organizations',
+                lambda: logic.get_action('organization_list') (context, { 'all_fields': True }))
+            if 'organizations' in options:
+                names = set(options['organizations'])
+                orgs = [org for org in orgs if org['name'] in names]
+            return orgs
         return logic.get_action('organization_list') (context, options)
 
     @classmethod
-    def organization_dict_objects(cls, org_names = []):
+    def organization_dict_objects(cls, org_names = [], user = None):
         ''' Similar to organization_list_objects but returns a dict keyed to the organization name. '''
+        if user is None:
+            prefetch = cls._prefetch()
+            if prefetch:
+                ok, result = prefetch.result('organizations')
+                if ok and result[1] == org_names:
+                    return result[2]
         results = {}
-        for org in cls.organization_list_objects(org_names):
+        for org in cls.organization_list_objects(org_names, user=user):
             results[org['name']] = org
         return results
 
@@ -114,6 +229,7 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
             'music_genres_options': self.music_genres_options,
             'organization_list_objects': self.organization_list_objects,
             'organization_dict_objects': self.organization_dict_objects,
+            'helloworld_organizations_available': self.organizations_available,
         }
 
     ## IConfigurer interface ##
@@ -128,8 +244,49 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
 
     def configure(self, config):
         ''' Apply configuration options to this plugin '''
+
+        recorder_path = config.get('ckanext.helloworld.recorder.path')
+        if recorder_path:
+            sample_rate = float(config.get('ckanext.helloworld.recorder.sample_rate', 1.0))
+            type(self).recorder = TrafficRecorder(recorder_path, sample_rate)
+            log1.info('Recording %.0f%% of dataset traffic to %s', sample_rate * 100, recorder_path)
+
+        if toolkit.asbool(config.get('ckanext.helloworld.shared_cache.enabled', False)):
+            cache_path = config.get('ckanext.helloworld.shared_cache.path') or os.path.join(
+                config.get('cache_dir') or tempfile.gettempdir(), 'helloworld-shared-cache')
+            ttl = int(config.get('ckanext.helloworld.shared_cache.ttl', 300))
+            type(self).shared_cache = SharedCache(cache_path, ttl=ttl)
+            log1.info('Sharing vocabulary and organization data at %s (ttl=%ds)', cache_path, ttl)
+
+        type(self).prefetch_timeout = float(config.get('ckanext.helloworld.prefetch.timeout', 2.0))
+        if self.prefetch_timeout > 0:
+            type(self).prefetch_pool = WorkerPool(int(config.get('ckanext.helloworld.prefetch.workers', 2)))
         pass
 
+    ## IActions interface ##
+
+    def get_actions(self):
+        from ckanext.helloworld.logic import action
+        return {
+            'package_validate_many': action.package_validate_many,
+        }
+
+    ## IAuthFunctions interface ##
+
+    def get_auth_functions(self):
+        from ckanext.helloworld.logic import auth
+        return {
+            'package_validate_many': auth.package_validate_many,
+        }
+
+    ## IMiddleware interface ##
+
+    def make_middleware(self, app, config):
+        ''' Answer conditional requests for (unchanged) datasets with 304 Not Modified '''
+        if not toolkit.asbool(config.get('ckanext.helloworld.conditional_get', True)):
+            return app
+        return ConditionalGetMiddleware(app, salt=config.get('ckanext.helloworld.etag_salt', ''))
+
     ## IDatasetForm interface ##
 
     def is_fallback(self):
@@ -151,7 +308,7 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
 
         # Define some closures as custom callbacks for the validation process
 
-        from ckan.lib.navl.dictization_functions import missing, StopOnError, Invalid
+        from ckan.lib.navl.dictization_functions import missing, StopOnError, Invalid, unflatten
 
         def music_title_converter_1(key, data, errors, context):
             ''' Demo of a typical behaviour inside a validator/converter '''
@@ -172,6 +329,85 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
             from string import capitalize
             return capitalize(value)
 
+        def next_tag_index(data):
+            ''' Return the index to append tags at, after any tags already present (as convert_to_tags does) '''
+            return 1 + max([k[1] for k in data.keys() if k[0] == 'tags' and len(k) > 1] or [-1])
+
+        def next_extra_index(data):
+            ''' Return the index to append extras at (as convert_to_extras does) '''
+            return 1 + max([k[1] for k in data.keys() if k[0] == 'extras' and len(k) > 1] or [-1])
+
+        def stored_genres(package):
+            ''' Return the (active) music_genres tags of a stored package '''
+            return [pt.tag for pt in package.package_tag_all
+                if pt.state == 'active' and pt.tag.vocabulary and pt.tag.vocabulary.name == 'music_genres']
+
+        def submitted_genres(data):
+            value = data.get(('music_genre',))
+            if value is missing or not value:
+                return []
+            return [value] if isinstance(value, basestring) else list(value)
+
+        convert_to_music_genres = toolkit.get_converter('convert_to_tags')('music_genres')
+
+        def music_genre_converter(key, data, errors, context):
+            ''' Convert genres to vocabulary tags as convert_to_tags does, but using the vocabulary
+            prefetched into the context (e.g. once for a batch of datasets), if any. '''
+            vocabulary = context.get('helloworld.vocabulary')
+            if not vocabulary:
+                return convert_to_music_genres(key, data, errors, context)
+            vocabulary_id, tag_names = vocabulary
+            genres = data.get(key)
+            if not genres:
+                return
+            if isinstance(genres, basestring):
+                genres = [genres]
+            for tag in genres:
+                if not tag in tag_names:
+                    raise Invalid(_t('Tag "%s" does not belong to vocabulary "%s"') % (tag, 'music_genres'))
+            n = next_tag_index(data)
+            for num, tag in enumerate(genres):
+                data[('tags', num + n, 'name')] = tag
+                data[('tags', num + n, 'vocabulary_id')] = vocabulary_id
+
+        def mark_unchanged(key, context):
+            ''' Record that the conversion of a field was skipped (reported at after_update) '''
+            context.setdefault('helloworld.unchanged_fields', []).append(key[0])
+
+        def music_title_unchanged(key, data, errors, context):
+            ''' Fast path for updates: if the submitted title equals the stored one, re-emit
+            the stored (already converted) extra and skip the rest of the converter chain. '''
+            package = context.get('package')
+            if not package:
+                # Not an update: nothing to compare against
+                return
+            stored = package.extras.get('music_title')
+            if stored is None or data.get(key) != stored:
+                return
+            # Emit the same (flattened) extra that convert_to_extras would
+            n = next_extra_index(data)
+            data[('extras', n, 'key')] = 'music_title'
+            data[('extras', n, 'value')] = stored
+            mark_unchanged(key, context)
+            raise StopOnError
+
+        def music_genre_unchanged(key, data, errors, context):
+            ''' Fast path for updates: if the submitted genres equal the stored ones, re-emit
+            the stored vocabulary tags and skip convert_to_tags (i.e. the vocabulary lookup
+            and the per-tag validation queries). '''
+            package = context.get('package')
+            if not package:
+                return
+            stored = stored_genres(package)
+            if not stored or sorted(submitted_genres(data)) != sorted(tag.name for tag in stored):
+                return
+            n = next_tag_index(data)
+            for num, tag in enumerate(stored):
+                data[('tags', num + n, 'name')] = tag.name
+                data[('tags', num + n, 'vocabulary_id')] = tag.vocabulary_id
+            mark_unchanged(key, context)
+            raise StopOnError
+
         def after_validation_processor(key, data, errors, context):
             assert key[0] == '__after', 'This validator can only be invoked in the __after stage'
             #raise Exception ('Breakpoint after_validation_processor')
@@ -179,13 +415,18 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
             extras_list = data.get(('extras',))
             if not extras_list:
                 extras_list = data[('extras',)] = []
-            # Note Append "record_modified_at" field as a non-input field
-            datestamp = time.strftime('%Y-%m-%d %T')
-            items = filter(lambda t: t['key'] == 'record_modified_at', extras_list)
-            if items:
-                items[0]['value'] = datestamp
-            else:
-                extras_list.append({ 'key': 'record_modified_at', 'value': datestamp })
+            # Note Append "record_revision" (a high-resolution monotonic stamp, used by 
+            # conditional requests) and "record_modified_at" fields as non-input fields
+            package = context.get('package')
+            # Note Both are bumped on every update (of any field), as they stamp the whole record
+            previous = package.extras.get('record_revision') if package else None
+            revision, datestamp = self.revision_stamps(previous)
+            for k, v in (('record_revision', revision), ('record_modified_at', datestamp)):
+                items = filter(lambda t: t['key'] == k, extras_list)
+                if items:
+                    items[0]['value'] = v
+                else:
+                    extras_list.append({ 'key': k, 'value': v })
             # Note Append "foo.x1" field as dynamic (not registered under modify schema) field  
             items = filter(lambda t: t['key'] == 'foo.x1', extras_list)
             if items:
@@ -194,6 +435,16 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
                 extras_list.append({ 'key': 'foo.x1', 'value': data.get(('foo.x1',)) })
                 
 
+        def record_payload(key, data, errors, context):
+            assert key[0] == '__before', 'This validator can only be invoked in the __before stage'
+            if context.get('helloworld.validate_only'):
+                return
+            # Record the payload as submitted (i.e. before any validation takes place)
+            payload = unflatten(dict((k, v) for k, v in data.items()
+                if not k[0].startswith('__') and v is not missing))
+            payload.update(data.get(('__extras',), {}))
+            self.recorder.record('update' if context.get('package') else 'create', payload)
+
         def before_validation_processor(key, data, errors, context):
             assert key[0] == '__before', 'This validator can only be invoked in the __before stage'
             #raise Exception ('Breakpoint before_validation_processor')
@@ -211,12 +462,14 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
             # Add our custom "music_genre" metadata field to the schema.
             'music_genre': [
                 toolkit.get_validator('ignore_missing'),
-                toolkit.get_converter('convert_to_tags')('music_genres'),
+                music_genre_unchanged,
+                music_genre_converter,
             ],
             # Add our "music_title" metadata field to the schema, this one will use
             # convert_to_extras instead of convert_to_tags.
             'music_title': [
                 toolkit.get_validator('ignore_missing'),
+                music_title_unchanged,
                 music_title_converter_1,
                 music_title_converter_2,
                 toolkit.get_converter('convert_to_extras'),
@@ -240,6 +493,9 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
         # any additional validator must be inserted before the default 'ignore' one. 
         schema['__before'].insert(-1, before_validation_processor) # insert as second-to-last
 
+        if self.recorder:
+            schema['__before'].insert(0, record_payload)
+
         return schema
 
     def create_package_schema(self):
@@ -274,6 +530,10 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
             'record_modified_at': [
                 toolkit.get_converter('convert_from_extras'),
             ],
+            'record_revision': [
+                toolkit.get_converter('convert_from_extras'),
+                toolkit.get_validator('ignore_missing')
+            ],
             # Add our dynamic (not registered at modify schema) field
             'foo.x1': [
                 toolkit.get_converter('convert_from_extras'),
@@ -303,6 +563,17 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
         if c.pkg_dict:
             c.pkg_dict['helloworld'] = { 'plugin-name': self.__class__.__name__ }
 
+        # Start the (independent) lookups needed by the dataset form, so that they run
+        # concurrently while the controller goes on; the helpers will pick their results
+        if self.prefetch_pool and c.action in ('new', 'edit'):
+            prefetch = Prefetch(self.prefetch_pool, self.prefetch_timeout)
+            prefetch.start('music_genres', self._lookup_music_genres)
+            # Note The form only lists organizations to sysadmins, or for new (draft) datasets
+            state = (c.pkg_dict or {}).get('state') if c.action == 'edit' else None
+            if getattr(c.userobj, 'sysadmin', False) or not state or state.startswith('draft'):
+                prefetch.start('organizations', self._organizations_with_objects, c.user, 'create_dataset')
+            c.helloworld_prefetch = prefetch
+
     # Note for all *_template hooks: 
     # We choose not to modify the path for each template (so we simply call the super() method). 
     # If a specific template's behaviour needs to be overriden, this can be done by means of 
@@ -334,6 +605,16 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
 
     def after_update(self, context, pkg_dict):
         log1.debug('after_update: Package %s is updated', pkg_dict.get('name'))
+
+        # Report the fields whose (unchanged) values bypassed conversion. These are skipped
+        # conversions (i.e. lookups and validation), not writes: the core save diffs the rows anyway.
+        # Note Pop them, so that a context reused for another call doesn't report them twice.
+        unchanged = context.pop('helloworld.unchanged_fields', None)
+        if unchanged:
+            cls = type(self)
+            cls.skipped_conversions += len(unchanged)
+            log1.info('after_update: Package %s: skipped conversion of unchanged fields %s (%d so far)',
+                pkg_dict.get('name'), ', '.join(unchanged), cls.skipped_conversions)
         pass
 
     def after_show(self, context, pkg_dict):
@@ -358,6 +639,9 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
         log1.debug('after_show: Package %s is shown: view=%s validated=%s api=%s', 
             pkg_dict.get('name'), for_view, is_validated, context.get('api_version'))
         
+        if self.recorder and is_validated and self._is_requested_show():
+            self.recorder.record('show', { 'id': pkg_dict.get('id') })
+
         if not is_validated:
             # Noop: the extras are not yet promoted to 1st-level fields
             return
@@ -367,7 +651,27 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
         return
         #return pkg_dict
      
+    @staticmethod
+    def _is_requested_show():
+        '''Check if this is the show a client asked for, i.e. the first one of a request for a
+        dataset page or for package_show (and not e.g. the one package_update returns) '''
+        try:
+            environ = toolkit.request.environ
+        except TypeError:
+            # Not inside a request (e.g. indexing from the command line)
+            return False
+        if environ.get('helloworld.show_recorded'):
+            return False
+        path = environ.get('PATH_INFO', '')
+        m = ConditionalGetMiddleware
+        if not (m.DATASET_PATH.match(path) or m.API_PATH.match(path)):
+            return False
+        environ['helloworld.show_recorded'] = True
+        return True
+
     def before_search(self, search_params):
+        if self.recorder:
+            self.recorder.record('search', search_params)
         #search_params['q'] = 'extras_qoo:*';
         #search_params['extras'] = { 'ext_qoo': 'far' }
         return search_params
@@ -408,4 +712,17 @@ class DatasetForm(p.SingletonPlugin, toolkit.DefaultDatasetForm):
         
         return pkg_dict
 
+class OrganizationCache(p.SingletonPlugin):
+    ''' A plugin that invalidates the (shared) organization data of DatasetForm, whenever
+    an organization is created, edited or deleted.
+
+    Note This is kept apart from DatasetForm, because the IOrganizationController hooks
+    are named as the IPackageController ones (e.g. before_view).
+    '''
+    p.implements(p.IOrganizationController, inherit=True)
+
+    def _invalidate_organizations(self, entity):
+        if DatasetForm.shared_cache:
+            DatasetForm.shared_cache.invalidate('organizations')
 
+    create = edit = delete = _invalidate_organizations
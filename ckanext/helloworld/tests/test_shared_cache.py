@@ -0,0 +1,105 @@
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from ckanext.helloworld.lib.shared_cache import SharedCache
+
+def _value(i):
+    # A value whose parts must agree, and whose (encoded) length varies
+    return { 'n': i, 'pad': 'x' * (i % 97) }
+
+def _write(path, key, count, invalidate):
+    cache = SharedCache(path)
+    for i in xrange(count):
+        if invalidate and i % 5 == 4:
+            cache.invalidate(key)
+        else:
+            cache.set(key, _value(i))
+
+def _read(path, key, count, invalidate, errors):
+    cache = SharedCache(path)
+    for i in xrange(count):
+        try:
+            value = cache.get(key)
+        except Exception as ex:
+            errors.put('get raised %r' % (ex))
+            return
+        if value is None and not invalidate:
+            # Never invalidated: a miss means a (torn) payload failed to decode
+            errors.put('unexpected miss')
+            return
+        if value is not None and value != _value(value['n']):
+            errors.put('inconsistent value %r' % (value))
+            return
+
+def _get(path, key, results):
+    results.put(SharedCache(path).get(key))
+
+def _set(path, key, value):
+    SharedCache(path).set(key, value)
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _run(self, target, *args):
+        proc = multiprocessing.Process(target=target, args=(self.path,) + args)
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 0)
+
+    def test_missing(self):
+        self.assertEqual(SharedCache(self.path).get('x'), None)
+
+    def test_cross_process_set_and_invalidate(self):
+        cache = SharedCache(self.path)
+        results = multiprocessing.Queue()
+        cache.set('x', [1, 2])
+        self._run(_get, 'x', results)
+        self.assertEqual(results.get(), [1, 2])
+
+        cache.invalidate('x')
+        self._run(_get, 'x', results)
+        self.assertEqual(results.get(), None)
+
+        # Another process writes a (longer) value: this process must not return
+        # the value it decoded before
+        self.assertEqual(cache.get('x'), None)
+        self._run(_set, 'x', range(1000))
+        self.assertEqual(cache.get('x'), range(1000))
+
+    def test_values_are_copies(self):
+        cache = SharedCache(self.path)
+        cache.set('x', [4])
+        cache.get('x').append(99)
+        self.assertEqual(cache.get('x'), [4])
+
+    def _run_concurrently(self, invalidate):
+        SharedCache(self.path).set('x', _value(0))
+        errors = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_write, args=(self.path, 'x', 3000, invalidate))]
+        procs.extend(multiprocessing.Process(target=_read, args=(self.path, 'x', 5000, invalidate, errors))
+            for i in range(3))
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        self.assertTrue(errors.empty(), errors.empty() or errors.get())
+        for proc in procs:
+            self.assertEqual(proc.exitcode, 0)
+
+    def test_concurrent_readers_see_complete_writes(self):
+        self._run_concurrently(invalidate=False)
+
+    def test_concurrent_readers_see_consistent_values(self):
+        self._run_concurrently(invalidate=True)
+
+    def test_ttl(self):
+        cache = SharedCache(self.path, ttl=-1)
+        cache.set('x', 1)
+        self.assertEqual(cache.get('x'), None)
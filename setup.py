@@ -29,6 +29,8 @@ setup(
 
         helloworld_dataset = ckanext.helloworld.plugins:DatasetForm
 
+        helloworld_organizations = ckanext.helloworld.plugins:OrganizationCache
+
         [paste.paster_command]
         
         helloworld = ckanext.helloworld.commands:Command